@@ -7,28 +7,16 @@ from typing import List, Tuple
 MAX_LINE_BUFFER_SIZE = 5000
 
 
-def build_lines(lines: List[Tuple[Matrix44, Matrix44]]) -> Tuple[np.ndarray, np.ndarray]:
+def build_lines(lines: List[Tuple[Matrix44, Matrix44]] | np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     """
     Builds a line mesh from a list of line segments defined by their start and end points.
-    :param lines: List of tuples, where each tuple contains the start and end points of a line segment.
+    :param lines: List of tuples (or an array of shape (n, 2, 3)), where each tuple contains the start and end points
+    of a line segment.
     :returns: Tuple containing the vertex data and index data of the line mesh.
     """
-    vertices = []
-    indices = []
-    index_counter = 0
-
-    for line in lines:
-        start, end = line
-        vertices.extend(start)
-        vertices.extend(end)
-
-        indices.append(index_counter)
-        indices.append(index_counter + 1)
-
-        index_counter += 2
-
-    vertex_data = np.array(vertices, dtype=np.float32)
-    index_data = np.array(indices, dtype=np.uint32)
+    # Every line contributes its start and end point, which are connected by consecutive indices
+    vertex_data = np.asarray(lines, dtype=np.float32).reshape(-1, 3)
+    index_data = np.arange(len(vertex_data), dtype=np.uint32)
 
     return vertex_data, index_data
 
@@ -6,6 +6,44 @@ from light import Light
 from pyrr import Quaternion, Vector3, Matrix44
 from render.shaders import Shaders
 from trimesh import Trimesh
+from numba import njit
+
+
+@njit('void(f8, f8, f8, f8, f8, f8, f8, f8, f8, f8, f4[:, ::1])', fastmath=True, cache=True)
+def trs_to_mat4(qx: float, qy: float, qz: float, qw: float, sx: float, sy: float, sz: float,
+                tx: float, ty: float, tz: float, out: np.ndarray) -> None:
+    """
+    Writes the translation * rotation * scale matrix into out, using the same row-major layout as pyrr.
+    :param qx: Rotation quaternion x.
+    :param qy: Rotation quaternion y.
+    :param qz: Rotation quaternion z.
+    :param qw: Rotation quaternion w.
+    :param sx: Scale on the x-axis.
+    :param sy: Scale on the y-axis.
+    :param sz: Scale on the z-axis.
+    :param tx: Translation on the x-axis.
+    :param ty: Translation on the y-axis.
+    :param tz: Translation on the z-axis.
+    :param out: Preallocated 4x4 matrix that receives the result.
+    """
+    # Rows hold the scaled rotation axes and the translation goes in the last row
+    s = 2.0 / (qx * qx + qy * qy + qz * qz + qw * qw)
+    out[0, 0] = (1.0 - s * (qy * qy + qz * qz)) * sx
+    out[0, 1] = s * (qx * qy - qz * qw) * sx
+    out[0, 2] = s * (qx * qz + qy * qw) * sx
+    out[0, 3] = 0.0
+    out[1, 0] = s * (qx * qy + qz * qw) * sy
+    out[1, 1] = (1.0 - s * (qx * qx + qz * qz)) * sy
+    out[1, 2] = s * (qy * qz - qx * qw) * sy
+    out[1, 3] = 0.0
+    out[2, 0] = s * (qx * qz - qy * qw) * sz
+    out[2, 1] = s * (qy * qz + qx * qw) * sz
+    out[2, 2] = (1.0 - s * (qx * qx + qy * qy)) * sz
+    out[2, 3] = 0.0
+    out[3, 0] = tx
+    out[3, 1] = ty
+    out[3, 2] = tz
+    out[3, 3] = 1.0
 
 
 class Model:
@@ -37,8 +75,9 @@ class Model:
 
         self.show_model = True
 
-        self.model_transformation = Matrix44.identity()
+        self.model_matrix_f32 = np.eye(4, dtype='f4')
         self.color = [0, 0, 0]
+        self.color_f32 = np.array(self.color, dtype='f4')
 
     def update(self, dt: float, interpolation_method: str) -> None:
         pass
@@ -54,7 +93,10 @@ class Model:
         Sets model's color.
         :param color: Model color.
         """
-        self.color = color
+        # Only rebuild the uniform data when the color actually changes
+        if color != self.color:
+            self.color = color
+            self.color_f32 = np.array(color, dtype='f4')
 
     def move(self, dx: float, dz: float) -> None:
         """
@@ -71,6 +113,9 @@ class Model:
         :param dx: Amount of translation on the x-axis.
         :param dz: Amount of translation on the z-axis.
         """
+        # Scenes re-apply the same translation every frame, only recalculate the matrix when it changes
+        if self.translation[0] == dx and self.translation[1] == 0 and self.translation[2] == dz:
+            return
         self.translation = Vector3([dx, 0, dz])
         self.calculate_model_matrix()
 
@@ -86,42 +131,68 @@ class Model:
         """
         Calculates the model's transformation matrix.
         """
-        trans = Matrix44.from_translation(self.translation)
-        rot = Matrix44.from_quaternion(Quaternion(self.rotation))
-        scale = Matrix44.from_scale(self.scale)
-        self.model_transformation = trans * rot * scale
+        x, y, z, w = self.rotation
+        sx, sy, sz = self.scale
+        tx, ty, tz = self.translation
+        trs_to_mat4(x, y, z, w, sx, sy, sz, tx, ty, tz, self.model_matrix_f32)
 
     def get_model_matrix(self) -> np.ndarray:
         """
         Returns the matrix of the model.
         :return: Model matrix.
         """
-        model = self.model_transformation
-        return np.array(model, dtype='f4')
+        return self.model_matrix_f32
 
-    def draw(self, proj_matrix: Matrix44, view_matrix: Matrix44, light: Light,) -> None:
+    @staticmethod
+    def write_scene_uniforms(proj_matrix: Matrix44, view_matrix: Matrix44, light: Light,
+                             camera_position: np.ndarray) -> None:
         """
-        Draws a 3D model.
+        Uploads the uniforms that are shared by all models, should be called once per frame before drawing them.
         :param proj_matrix: Projection matrix.
         :param view_matrix: View matrix.
         :param light: Scene light.
+        :param camera_position: Camera position as a float32 array.
         """
-        command = self.command
-        texture, vao = command[1], command[0]
-
-        prog = self.prog
+        # All models use the same program, so these only have to be written once instead of for every model
+        prog = Shaders.instance().get('base-flat')
         prog['light.Ia'].write(light.Ia)
         prog['light.Id'].write(light.Id)
         prog['light.Is'].write(light.Is)
         prog['light.position'].write(light.position)
-        prog['camPos'].write(np.array(self.app.camera.position, dtype='f4'))
-
-        prog['model'].write(self.get_model_matrix())
+        prog['camPos'].write(camera_position)
         prog['view'].write(view_matrix)
         prog['projection'].write(proj_matrix)
-        prog['ucolor'].write(np.array(self.color, dtype='f4'))
+
+    def bind_uniforms(self) -> None:
+        """
+        Writes the per-object uniforms of the model. The scene uniforms must already have been written with
+        write_scene_uniforms.
+        """
+        self.prog['model'].write(self.model_matrix_f32)
+        self.prog['ucolor'].write(self.color_f32)
+
+    def write_color(self, color: np.ndarray) -> None:
+        """
+        Overrides the color uniform for the next draw, without changing the model's color.
+        :param color: Color as a float32 array.
+        """
+        self.prog['ucolor'].write(color)
+
+    def issue_draw(self) -> None:
+        """
+        Renders the model with the uniforms that are currently bound.
+        """
+        command = self.command
+        texture, vao = command[1], command[0]
 
         if texture is not None:
             texture.use()
 
         vao.render()
+
+    def draw(self) -> None:
+        """
+        Draws a 3D model. The scene uniforms must already have been written with write_scene_uniforms.
+        """
+        self.bind_uniforms()
+        self.issue_draw()
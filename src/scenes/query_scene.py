@@ -21,29 +21,6 @@ import matplotlib.pyplot as plt
 import mplcursors
 
 
-def normalize_single_features(mesh_features: dict[str, ShapeDescriptors]) -> None:
-    """
-    Normalizes the single features of a shape.
-    :param mesh_features: Features of the shape.
-    """
-    # Extract the feature descriptors from the dictionary values
-    feature_values = [descriptor.get_single_features() for descriptor in mesh_features.values()]
-
-    features_array = np.array(feature_values)
-
-    mean = np.mean(features_array, axis=0)
-    std = np.std(features_array, axis=0)
-
-    # Avoid division by zero in case of a zero standard deviation
-    std[std == 0] = 1
-
-    standardized_features = (features_array - mean) / std
-
-    # Iterate over the items in the dictionary to set the normalized features
-    for (key, descriptor), standardized_feature in zip(mesh_features.items(), standardized_features):
-        descriptor.normalize_single_features(standardized_feature)
-
-
 def load_model(path: tuple[str, str, str]) -> tuple[trimesh.Trimesh, str, str]:
     """
     Load model from path.
@@ -69,6 +46,8 @@ class QueryScene(Scene):
     skybox = None
     lines = None
     current_shading_mode = "flat"
+    shape_color = [1, 1, 1, 1]
+    wireframe_color = np.array([0, 0, 0, 0], dtype='f4')
 
     # Models
     models = {}
@@ -87,6 +66,7 @@ class QueryScene(Scene):
     poorly_sampled = []
     refined = []
     models_of_current_class = None
+    sorted_model_names = {}
 
     all_model_names = {}
     all_meshes = {}
@@ -109,29 +89,26 @@ class QueryScene(Scene):
     selected_class = 0
     selected_model = 0
     selected_poorly_sampled = 0
+    poorly_sampled_labels = []
     selected_distance_id = 0
     selected_distance = "Euclidean"
-    available_distances = ["Euclidean",
-                           "Cosine",
-                           "EMD",
-                           "Euclidean (Single) + EMD (Histogram)",
-                           "Euclidean (Single) + Cosine (Histogram)",
-                           "Cosine (Single) + EMD (Histogram)",
-                           "Cosine (Single) + Euclidean (Histogram)",
-                           "EMD (Single) + Euclidean (Histogram)",
-                           "EMD (Single) + Cosine (Histogram)",
-                           ]
+    available_distances = list(DISTANCE_METRICS.keys())
 
     # Query
     index = None
+    descriptor_store = None
     distances = None
     neighbor_count = 1
     best_matching_shapes = []
     shapes_per_class = {}
+    evaluation_subjects = []
     selected_evaluation_subject = 0
     precisions, recalls, f1_scores = {}, {}, {}
 
     def load(self) -> None:
+        # Change the style of the entire ImGui interface, this is global state so it only has to be set once
+        imgui.style_colors_classic()
+
         self.skybox = Skybox(self.app, skybox='clouds', ext='png')
         paths_to_load = []
 
@@ -160,6 +137,11 @@ class QueryScene(Scene):
             self.all_model_names[model_class].append(model_name)
             self.all_meshes[model_name] = mesh[0]
 
+        # The classes do not change after loading, so the UI lists are only built once
+        self.sorted_model_names = {key: sorted(value) for key, value in self.all_model_names.items()}
+        self.shapes_per_class = {key: len(value) for key, value in self.all_model_names.items()}
+        self.evaluation_subjects = ["Average"] + list(self.shapes_per_class.keys())
+
         self.average_model, all_neighbors = return_neighbors()
 
         # Average model mesh and info
@@ -212,6 +194,7 @@ class QueryScene(Scene):
 
         self.poorly_sampled = sorted(self.poorly_sampled, key=lambda x: x[5])
         self.refined = sorted(self.refined, key=lambda x: x[5])
+        self.poorly_sampled_labels = [f"{shape[4]}({shape[5]})" for shape in self.poorly_sampled]
 
         self.light = Light(
             position=Vector3([5., 5., 5.], dtype='f4'),
@@ -221,7 +204,9 @@ class QueryScene(Scene):
         self.current_shading_mode = 0
         self.lines = Lines(self.app, line_width=1)
 
-        normalize_single_features(self.all_descriptors)
+        # Keep the features of all shapes in contiguous matrices and standardize their single features in one go
+        self.descriptor_store = DescriptorStore(self.all_descriptors)
+        self.descriptor_store.normalize_single_features()
 
         # Setting up ANN query
         print("< Setting up ANN Query...")
@@ -247,9 +232,6 @@ class QueryScene(Scene):
         """
         imgui.new_frame()
 
-        # Change the style of the entire ImGui interface
-        imgui.style_colors_classic()
-
         imgui.set_next_window_position(0, 20, imgui.ONCE)
 
         # Add an ImGui window
@@ -294,7 +276,7 @@ class QueryScene(Scene):
             imgui.indent(16)
             _, self.selected_poorly_sampled = imgui.combo(" ",
                                                           self.selected_poorly_sampled,
-                                                          [f"{shape[4]}({shape[5]})" for shape in self.poorly_sampled])
+                                                          self.poorly_sampled_labels)
             imgui.unindent(32)
             self.show_normalized = False
             self.evaluate_cbsr = False
@@ -355,13 +337,13 @@ class QueryScene(Scene):
                     self.all_meshes[self.current_model_name].bounds, None)
                 self.all_barycenter_lines[self.current_model_name] = get_basis_lines(None, mesh.centroid)
 
-                self.models_of_current_class = sorted(self.all_model_names[self.current_class])
+                self.models_of_current_class = self.sorted_model_names[self.current_class]
                 self.current_model_id = 0
                 self.selected_normalized = True
 
             # Add a combo box for models based on selected class
             if self.current_class and self.current_class in self.all_model_names:
-                self.models_of_current_class = sorted(self.all_model_names[self.current_class])
+                self.models_of_current_class = self.sorted_model_names[self.current_class]
 
                 clicked, self.current_model_id = imgui.combo("Models", self.current_model_id,
                                                              self.models_of_current_class)
@@ -394,16 +376,15 @@ class QueryScene(Scene):
             imgui.spacing()
             imgui.indent(16)
             clicked, self.selected_distance_id = imgui.combo("      ", self.selected_distance_id,
-                                                             [distance for distance in self.available_distances])
+                                                             self.available_distances)
             imgui.unindent(16)
             if clicked:
                 self.selected_distance = self.available_distances[self.selected_distance_id]
             imgui.spacing()
             if imgui.button("Get Best-Matching Shapes (Custom)"):
                 matching_names, self.distances = get_best_matching_shapes(
-                    self.all_descriptors[self.current_model_name],
-                    {key: value for key, value in self.all_descriptors.items() if key != self.current_model_name},
-                    self.neighbor_count, self.selected_distance)
+                    self.all_descriptors[self.current_model_name], self.all_descriptors, self.neighbor_count,
+                    self.selected_distance, self.descriptor_store, exclude=self.current_model_name)
                 self.best_matching_shapes = [(Model(self.app, name, self.all_meshes[name]), name) for name in
                                              matching_names]
                 for name in matching_names:
@@ -418,7 +399,8 @@ class QueryScene(Scene):
                 )
 
                 self.distances = distances.flatten().tolist()[1:]
-                matching_names = [list(self.all_descriptors.keys())[k] for k in neighbor_indexes.flatten().tolist()[1:]]
+                model_names = list(self.all_descriptors.keys())
+                matching_names = [model_names[k] for k in neighbor_indexes.flatten().tolist()[1:]]
                 self.best_matching_shapes = [(Model(self.app, name, self.all_meshes[name]), name) for name in
                                              matching_names]
                 for name in matching_names:
@@ -561,7 +543,6 @@ class QueryScene(Scene):
 
             if self.evaluate_cbsr:
                 imgui.indent(16)
-                self.shapes_per_class = {key: len(value) for key, value in self.all_model_names.items()}
                 self.show_poorly_sampled = False
                 self.show_normalized = False
 
@@ -576,7 +557,7 @@ class QueryScene(Scene):
                 imgui.spacing()
                 imgui.indent(16)
                 clicked, self.selected_distance_id = imgui.combo("              ", self.selected_distance_id,
-                                                                 [distance for distance in self.available_distances])
+                                                                 self.available_distances)
                 imgui.spacing()
                 imgui.unindent(16)
                 if clicked:
@@ -585,7 +566,7 @@ class QueryScene(Scene):
                 if imgui.button("Evaluate Custom Query"):
                     self.precisions, self.recalls, self.f1_scores = evaluate_query(
                         "Custom", self.all_descriptors, self.neighbor_count, self.shapes_per_class,
-                        self.all_model_names, None, self.selected_distance
+                        self.all_model_names, None, self.selected_distance, self.descriptor_store
                     )
                     self.evaluate = True
 
@@ -600,11 +581,7 @@ class QueryScene(Scene):
                     imgui.set_next_window_position(0, 600, imgui.ONCE)
 
                     if imgui.begin("Evaluation Results:", True):
-                        if self.selected_evaluation_subject == 0:
-                            evaluation_subject = "Average"
-                        else:
-                            evaluation_subject = list(self.shapes_per_class.keys())[
-                                self.selected_evaluation_subject - 1]
+                        evaluation_subject = self.evaluation_subjects[self.selected_evaluation_subject]
                         imgui.text(f"{evaluation_subject} Query Precision: {self.precisions[evaluation_subject]:.3f}")
                         imgui.text(f"{evaluation_subject} Query Recall: {self.recalls[evaluation_subject]:.3f}")
                         imgui.text(f"{evaluation_subject} Query F1 Score: {self.f1_scores[evaluation_subject]:.3f}")
@@ -615,9 +592,7 @@ class QueryScene(Scene):
                         imgui.indent(16)
                         changed, self.selected_evaluation_subject = imgui.combo("",
                                                                                 self.selected_evaluation_subject,
-                                                                                ["Average"] +
-                                                                                [shape_name for shape_name
-                                                                                 in self.shapes_per_class.keys()])
+                                                                                self.evaluation_subjects)
                     imgui.end()
 
         if not self.show_normalized and not self.show_poorly_sampled:
@@ -630,12 +605,10 @@ class QueryScene(Scene):
 
         self.app.imgui.render(imgui.get_draw_data())
 
-    def render_shapes(self, color: list[int] = [1, 1, 1, 1]) -> None:
+    def render_shapes(self) -> None:
         """
         Renders one or more shapes.
-        :param color: Shape color.
         """
-
         def draw_shape(model: Model, name: str, translation: float = 0) -> None:
             """
             Renders a shape.
@@ -643,12 +616,17 @@ class QueryScene(Scene):
             :param name: Model name.
             :param translation: Tranlsation of the model that will be rendered.
             """
-            model.color = color
-            model.draw(
-                self.app.camera.projection.matrix,
-                self.app.camera.matrix,
-                self.light
-            )
+            model.set_color(self.shape_color)
+            model.bind_uniforms()
+
+            # Draw the black wireframe first and then the shape itself with the same uniforms, only the color changes
+            if self.show_wireframe:
+                self.app.ctx.wireframe = True
+                model.write_color(self.wireframe_color)
+                model.issue_draw()
+                self.app.ctx.wireframe = False
+                model.write_color(model.color_f32)
+            model.issue_draw()
             model.translate(translation, 0)
 
             if self.show_bb:
@@ -683,9 +661,9 @@ class QueryScene(Scene):
                 # Render refined shape next to its poorly-sampled counterpart
                 sample = self.refined[self.selected_poorly_sampled]
                 bb = sample[1]
-                x_coordinates = [point[0][0] for point in bb]
-                min_x = min(x_coordinates)
-                max_x = max(x_coordinates)
+                x_coordinates = bb[:, 0, 0]
+                min_x = x_coordinates.min()
+                max_x = x_coordinates.max()
                 width = max_x - min_x
                 translation = width + 1
                 draw_shape(sample[0], sample[4], translation)
@@ -696,10 +674,10 @@ class QueryScene(Scene):
         """
         self.skybox.draw(self.app.camera.projection.matrix, self.app.camera.matrix)
 
-        if self.show_wireframe:
-            self.app.ctx.wireframe = True
-            self.render_shapes(color=[0, 0, 0, 0])
-            self.app.ctx.wireframe = False
+        # Camera and light are the same for every model in both passes, upload them once per frame
+        camera_position = np.asarray(self.app.camera.position, dtype='f4')
+        Model.write_scene_uniforms(self.app.camera.projection.matrix, self.app.camera.matrix, self.light,
+                                   camera_position)
 
         self.render_shapes()
         self.render_ui()
@@ -1,41 +1,41 @@
 from __future__ import annotations
 import trimesh
 import numpy as np
-from numba import njit
-from tools.descriptor_extraction import ShapeDescriptors
+from numba import njit, prange
+from scipy.spatial.distance import cdist
+from tools.descriptor_extraction import ShapeDescriptors, DescriptorStore
 from pynndescent import NNDescent
 from tqdm import tqdm
 
 THRESHOLD = 500
+# Maximum number of simplify and subdivide rounds in resample
+MAX_RESAMPLE_ITERATIONS = 10
 
 
-def get_bb_lines(bounding_box: np.ndarray[float]) -> list[tuple[float, float]]:
+# Selects for each of the 8 bounding box corners whether its x, y and z come from the max (True) or min (False) corner
+CORNER_MASK = np.array([
+    [0, 0, 0], [0, 0, 1], [0, 1, 0], [0, 1, 1],
+    [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1],
+], dtype=bool)
+
+# Pairs of corners that are connected by the 12 bounding box edges
+EDGE_INDICES = np.array([
+    (0, 1), (0, 2), (0, 4),
+    (7, 6), (7, 5), (7, 3),
+    (1, 5), (1, 3),
+    (2, 6), (2, 3),
+    (4, 5), (4, 6),
+], dtype=np.int32)
+
+
+def get_bb_lines(bounding_box: np.ndarray[float]) -> np.ndarray:
     """
     Gets the bounding box connections of a shape's bounding box coordinates.
     :param bounding_box: Shape bounding box.
-    :return: Bounding box connections
+    :return: Bounding box connections, as a (12, 2, 3) array with the start and end point of every edge.
     """
-    x0, y0, z0 = bounding_box[0][0], bounding_box[0][1], bounding_box[0][2]
-    x1, y1, z1 = bounding_box[1][0], bounding_box[1][1], bounding_box[1][2]
-
-    p000 = (x0, y0, z0)
-    p001 = (x0, y0, z1)
-    p010 = (x0, y1, z0)
-    p011 = (x0, y1, z1)
-    p100 = (x1, y0, z0)
-    p101 = (x1, y0, z1)
-    p110 = (x1, y1, z0)
-    p111 = (x1, y1, z1)
-
-    connections = [
-        (p000, p001), (p000, p010), (p000, p100),
-        (p111, p110), (p111, p101), (p111, p011),
-        (p001, p101), (p001, p011),
-        (p010, p110), (p010, p011),
-        (p100, p101), (p100, p110),
-    ]
-
-    return connections
+    corners = np.where(CORNER_MASK, bounding_box[1], bounding_box[0]).astype(np.float32)
+    return corners[EDGE_INDICES]
 
 
 def get_basis_lines(bounding_box: np.ndarray, barycenter: np.ndarray) -> list[tuple[any, any]]:
@@ -78,17 +78,51 @@ def resample(mesh: trimesh.Trimesh, target_vertices: int) -> trimesh.Trimesh:
     Resamples a mesh to a specific target number of vertices.
     :param mesh: Model mesh.
     :param target_vertices: Target vertices to resample to.
-    :return: Resampled mesh.
+    :return: Resampled mesh, as close to the target as could be reached.
     """
-    while len(mesh.vertices) > target_vertices + THRESHOLD or len(mesh.vertices) < target_vertices - THRESHOLD:
+    # Number of vertices that are left per requested face, updated with what every simplification actually produced.
+    # Only computed once a simplification is needed, meshes without faces can still be within the threshold
+    vertices_per_face = None
+
+    for _ in range(MAX_RESAMPLE_ITERATIONS):
+        num_vertices = len(mesh.vertices)
+        if target_vertices - THRESHOLD <= num_vertices <= target_vertices + THRESHOLD:
+            break
+
         # If number of vertices is too high, simplify
-        if len(mesh.vertices) > target_vertices + THRESHOLD:
-            new_face_count = target_vertices * (len(mesh.faces) / len(mesh.vertices))
-            mesh = mesh.simplify_quadratic_decimation(new_face_count)
+        if num_vertices > target_vertices + THRESHOLD:
+            if vertices_per_face is None:
+                if len(mesh.faces) == 0:
+                    break
+                vertices_per_face = num_vertices / len(mesh.faces)
+
+            new_face_count = int(target_vertices / vertices_per_face)
+            simplified_mesh = mesh.simplify_quadratic_decimation(new_face_count)
 
-        # If number of vertices is too low, subdivide
-        if len(mesh.vertices) < target_vertices - THRESHOLD:
-            mesh = trimesh.Trimesh(*trimesh.remesh.subdivide(mesh.vertices, mesh.faces))
+            # Stop if the simplification does not make any progress anymore
+            if len(simplified_mesh.vertices) >= num_vertices:
+                break
+
+            # Secant step, the next face count is based on the vertex count that this face count resulted in.
+            # The ratio is kept across subdivisions, which roughly preserve it
+            vertices_per_face = len(simplified_mesh.vertices) / new_face_count
+            mesh = simplified_mesh
+
+        # If number of vertices is too low, subdivide as many times as needed before building a new mesh
+        else:
+            vertices, faces = mesh.vertices, mesh.faces
+            while len(vertices) < target_vertices - THRESHOLD:
+                previous_num_vertices = len(vertices)
+                vertices, faces = trimesh.remesh.subdivide(vertices, faces)
+
+                # Stop if subdividing does not add vertices anymore, for example for meshes without faces
+                if len(vertices) <= previous_num_vertices:
+                    break
+
+            # Give up if the subdivision did not make any progress at all
+            if len(vertices) <= num_vertices:
+                break
+            mesh = trimesh.Trimesh(vertices, faces)
     return mesh
 
 
@@ -110,159 +144,177 @@ def normalize_single_features(mesh_features: ShapeDescriptors) -> None:
         descriptor.normalize_single_features(standardized_features[i])
 
 
-@njit
-def euclidean_distance(x1: np.ndarray, x2: np.ndarray) -> float:
-    """
-    Calculates the Euclidean distance between 2 samples.
-    :param x1: 1st sample.
-    :param x2: 2nd sample.
-    :return: Euclidean distance between the 2 samples.
-    """
-    return np.sqrt(np.sum((x1 - x2) ** 2))
+# Identifiers of the distance kernels of the compiled batched kernel
+EUCLIDEAN_KERNEL = 0
+COSINE_KERNEL = 1
+EMD_KERNEL = 2
 
+# Distance kernels, along with the suffix of the feature matrices they are computed on
+DISTANCE_KERNELS = {
+    "Euclidean": (EUCLIDEAN_KERNEL, ""),
+    "Cosine": (COSINE_KERNEL, "_unit"),
+    "EMD": (EMD_KERNEL, "_cumsum"),
+}
 
-@njit
-def cosine_distance(x1: np.ndarray, x2: np.ndarray) -> float:
+
+@njit(fastmath=True, cache=True)
+def kernel_distance(kernel: int, x1: np.ndarray, x2: np.ndarray) -> float:
     """
-    Calculates the Cosine distance between 2 samples.
-    :param x1: 1st sample.
-    :param x2: 2nd sample.
-    :return: Cosine distance between the 2 samples.
+    Calculates the distance between 2 samples with one of the distance kernels.
+    :param kernel: Distance kernel identifier.
+    :param x1: 1st sample (unit-length for Cosine, cumulative sums for EMD).
+    :param x2: 2nd sample (unit-length for Cosine, cumulative sums for EMD).
+    :return: Distance between the 2 samples.
     """
-    dot_product = np.dot(x1, x2)
-    norm_x1 = np.linalg.norm(x1)
-    norm_x2 = np.linalg.norm(x2)
-
-    cosine_similarity = dot_product / (norm_x1 * norm_x2)
-
-    # Cosine distance is complementary to cosine similarity
-    cosine_distance = 1 - cosine_similarity
-
-    return cosine_distance
-
-
-@njit
-def earth_movers_distance(x1, x2):
+    distance = 0.0
+    if kernel == EUCLIDEAN_KERNEL:
+        for j in range(x1.shape[0]):
+            difference = x1[j] - x2[j]
+            distance += difference * difference
+        return np.sqrt(distance)
+    elif kernel == COSINE_KERNEL:
+        for j in range(x1.shape[0]):
+            distance += x1[j] * x2[j]
+        return 1 - distance
+    else:
+        # Earth Mover's Distance of 1D histograms as the L1 distance of their cumulative sums
+        # (taken from: https://gist.github.com/jgraving/db2bf2fab8d623557e26eb363dd91af9/23e5df5b702f54e09984a04b83fa392edc6b8360)
+        for j in range(x1.shape[0]):
+            distance += abs(x1[j] - x2[j])
+        return distance
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def batched_distances(
+        single_query: np.ndarray, histogram_query: np.ndarray, single_matrix: np.ndarray, histogram_matrix: np.ndarray,
+        single_kernel: int, histogram_kernel: int, single_weight: float, histogram_weight: float, out: np.ndarray
+) -> None:
     """
-    Calculates the Earth Mover's Distance between 2 samples
-    (taken from: https://gist.github.com/jgraving/db2bf2fab8d623557e26eb363dd91af9/23e5df5b702f54e09984a04b83fa392edc6b8360)
-    :param x1: 1st sample.
-    :param x2: 2nd sample.
-    :return: Earth Mover's Distance between the 2 samples.
+    Calculates the weighted distances between a query and every row of the database matrices in parallel.
+    :param single_query: Query features of the 1st metric component.
+    :param histogram_query: Query features of the 2nd metric component.
+    :param single_matrix: Database features of the 1st metric component (one row per shape).
+    :param histogram_matrix: Database features of the 2nd metric component (one row per shape).
+    :param single_kernel: Distance kernel of the 1st metric component.
+    :param histogram_kernel: Distance kernel of the 2nd metric component.
+    :param single_weight: Weight of the 1st metric component.
+    :param histogram_weight: Weight of the 2nd metric component (0 if the metric has a single component).
+    :param out: Output array with the distance of each row.
     """
-    n = len(x1)
-    ac = 0
-    bc = 0
-    diff = 0
-    for i in range(n):
-        ac += x1[i]
-        bc += x2[i]
-        diff += abs(ac - bc)
-    return diff
+    for i in prange(single_matrix.shape[0]):
+        distance = single_weight * kernel_distance(single_kernel, single_query, single_matrix[i])
+        if histogram_weight != 0:
+            distance += histogram_weight * kernel_distance(histogram_kernel, histogram_query, histogram_matrix[i])
+        out[i] = distance
+
+
+# Components of each distance metric as (features, kernel, weight) tuples.
+# The plain metrics are computed on the weighted features, the combined ones on the single and histogram features.
+DISTANCE_METRICS = {
+    "Euclidean": (("weighted", "Euclidean", 1.0),),
+    "Cosine": (("weighted", "Cosine", 1.0),),
+    "EMD": (("weighted", "EMD", 1.0),),
+    "Euclidean (Single) + EMD (Histogram)": (("single", "Euclidean", 0.5), ("histogram", "EMD", 0.5)),
+    "Euclidean (Single) + Cosine (Histogram)": (("single", "Euclidean", 0.04), ("histogram", "Cosine", 0.96)),
+    "Cosine (Single) + EMD (Histogram)": (("single", "Cosine", 0.5), ("histogram", "EMD", 0.5)),
+    "Cosine (Single) + Euclidean (Histogram)": (("single", "Cosine", 0.4), ("histogram", "Euclidean", 0.6)),
+    "EMD (Single) + Euclidean (Histogram)": (("single", "EMD", 0.03), ("histogram", "Euclidean", 0.97)),
+    "EMD (Single) + Cosine (Histogram)": (("single", "EMD", 0.01), ("histogram", "Cosine", 0.99)),
+}
 
 
 def get_best_matching_shapes(
-        current_mesh, all_meshes, num_neighbors: int, distance_metric: str
+        current_mesh, all_meshes, num_neighbors: int, distance_metric: str, descriptor_store: DescriptorStore,
+        exclude: str | None = None
 ) -> tuple[list[str], list[float]]:
     """
     Gets the n best-matching shapes of a query shape based on a distance metric.
     :param current_mesh: Mesh of the query shape.
-    :param all_meshes: All database meshes except the query shape.
+    :param all_meshes: All database meshes.
     :param num_neighbors: Number of best-matching shapes to return.
-    :param distance_metric: Distance metric to use.
+    :param distance_metric: Distance metric to use (one of the DISTANCE_METRICS keys).
+    :param descriptor_store: Descriptor Store holding the features of all database meshes.
+    :param exclude: Name of a shape that should not be returned (usually the query shape itself).
     :return: Tuple of the n best-matching shapes and their distances to the query shape.
     """
-    distances = {}
-    for model_name, mesh in all_meshes.items():
-        if distance_metric == "Euclidean":
-            current_features = np.array(current_mesh.get_weighted_normalized_features())
-            mesh_features = np.array(mesh.get_weighted_normalized_features())
-
-            distances[model_name] = euclidean_distance(current_features, mesh_features)
-        elif distance_metric == "Cosine":
-            current_features = np.array(current_mesh.get_weighted_normalized_features())
-            mesh_features = np.array(mesh.get_weighted_normalized_features())
-
-            distances[model_name] = cosine_distance(current_features, mesh_features)
-        elif distance_metric == "EMD":
-            current_features = np.array(current_mesh.get_weighted_normalized_features())
-            mesh_features = np.array(mesh.get_weighted_normalized_features())
-
-            distances[model_name] = earth_movers_distance(current_features, mesh_features)
-
-        elif distance_metric == "Euclidean (Single) + EMD (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
-
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
-
-            single_distance = euclidean_distance(current_single_features, mesh_single_features)
-            histogram_distance = earth_movers_distance(current_histogram_features, mesh_histogram_features)
-
-            distances[model_name] = single_distance * 0.5 + histogram_distance * 0.5
-
-        elif distance_metric == "Euclidean (Single) + Cosine (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
-
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
-
-            single_distance = euclidean_distance(current_single_features, mesh_single_features)
-            histogram_distance = cosine_distance(current_histogram_features, mesh_histogram_features)
-
-            distances[model_name] = single_distance * 0.04 + histogram_distance * 0.96
-        elif distance_metric == "Cosine (Single) + EMD (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
-
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
-
-            single_distance = cosine_distance(current_single_features, mesh_single_features)
-            histogram_distance = earth_movers_distance(current_histogram_features, mesh_histogram_features)
-
-            distances[model_name] = single_distance * 0.5 + histogram_distance * 0.5
-        elif distance_metric == "Cosine (Single) + Euclidean (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
-
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
-
-            single_distance = cosine_distance(current_single_features, mesh_single_features)
-            histogram_distance = euclidean_distance(current_histogram_features, mesh_histogram_features)
-
-            distances[model_name] = single_distance * 0.4 + histogram_distance * 0.6
-        elif distance_metric == "EMD (Single) + Euclidean (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
-
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
-
-            single_distance = earth_movers_distance(current_single_features, mesh_single_features)
-            histogram_distance = euclidean_distance(current_histogram_features, mesh_histogram_features)
-
-            distances[model_name] = single_distance * 0.03 + histogram_distance * 0.97
-        elif distance_metric == "EMD (Single) + Cosine (Histogram)":
-            current_single_features = np.array(current_mesh.get_normalized_single_features())
-            current_histogram_features = np.array(current_mesh.get_normalized_histogram_features())
+    if distance_metric not in DISTANCE_METRICS:
+        return [], []
+
+    # Resolve the components of the metric, the 2nd one gets a zero weight for the plain metrics
+    components = []
+    for features, kernel, weight in DISTANCE_METRICS[distance_metric]:
+        kernel_id, representation = DISTANCE_KERNELS[kernel]
+        components.append((features + representation, kernel_id, weight))
+    if len(components) == 1:
+        components.append((components[0][0], components[0][1], 0.0))
+    (single_matrix, single_kernel, single_weight), (histogram_matrix, histogram_kernel, histogram_weight) = components
+
+    # A query shape that is not in a store has no cached features yet, so compute them without attaching it
+    if current_mesh.store is None:
+        query_features = current_mesh.get_cached_features()
+    else:
+        query_features = {attribute: getattr(current_mesh, attribute)
+                          for attribute in DescriptorStore.FEATURE_ATTRIBUTES.values()}
+
+    distances = np.empty(len(descriptor_store), dtype=np.float32)
+    batched_distances(
+        query_features[DescriptorStore.FEATURE_ATTRIBUTES[single_matrix]],
+        query_features[DescriptorStore.FEATURE_ATTRIBUTES[histogram_matrix]],
+        descriptor_store[single_matrix], descriptor_store[histogram_matrix],
+        single_kernel, histogram_kernel, single_weight, histogram_weight, distances
+    )
+
+    # The excluded shape can never be selected, but its distance is still dropped from the returned distances
+    model_names = descriptor_store.model_names
+    candidate_distances = distances
+    num_candidates = len(distances)
+    excluded_index = descriptor_store.model_indices.get(exclude)
+    if excluded_index is not None:
+        candidate_distances = distances.copy()
+        candidate_distances[excluded_index] = np.inf
+        num_candidates -= 1
+        distances = np.delete(distances, excluded_index)
+
+    # Partition out the n smallest distances and only sort those
+    num_neighbors = max(0, min(num_neighbors, num_candidates))
+    if num_neighbors > 0:
+        best_matching_indices = np.argpartition(candidate_distances, num_neighbors - 1)[:num_neighbors]
+        best_matching_indices = best_matching_indices[
+            np.argsort(candidate_distances[best_matching_indices], kind="stable")
+        ]
+    else:
+        best_matching_indices = []
+    best_matching_shapes = [model_names[i] for i in best_matching_indices]
 
-            mesh_single_features = np.array(mesh.get_normalized_single_features())
-            mesh_histogram_features = np.array(mesh.get_normalized_histogram_features())
+    return best_matching_shapes, distances.tolist()
 
-            single_distance = earth_movers_distance(current_single_features, mesh_single_features)
-            histogram_distance = cosine_distance(current_histogram_features, mesh_histogram_features)
 
-            distances[model_name] = single_distance * 0.01 + histogram_distance * 0.99
+def get_distance_matrix(descriptor_store: DescriptorStore, distance_metric: str) -> np.ndarray:
+    """
+    Computes the distances between all pairs of shapes at once.
+    :param descriptor_store: Descriptor Store holding the features of all shapes.
+    :param distance_metric: Distance metric to use (one of the DISTANCE_METRICS keys).
+    :return: Matrix where entry (i, j) is the distance between the i-th and j-th shape.
+    """
+    distance_matrix = None
+    for features, kernel, weight in DISTANCE_METRICS[distance_metric]:
+        kernel_id, representation = DISTANCE_KERNELS[kernel]
+        matrix = descriptor_store[features + representation]
+
+        # Each kernel reduces to a single BLAS-backed call on its precomputed representation
+        if kernel_id == EUCLIDEAN_KERNEL:
+            component_distances = cdist(matrix, matrix, "euclidean")
+        elif kernel_id == COSINE_KERNEL:
+            component_distances = 1 - matrix @ matrix.T
+        else:
+            component_distances = cdist(matrix, matrix, "cityblock")
 
-    sorted_distances = sorted(distances.items(), key=lambda item: item[1])
-    best_matching_shapes = [model_name for model_name, _ in sorted_distances[:num_neighbors]]
-    distances = [distance[1] for distance in distances.items()]
+        if distance_matrix is None:
+            distance_matrix = weight * component_distances
+        else:
+            distance_matrix += weight * component_distances
 
-    return best_matching_shapes, distances
+    return distance_matrix
 
 
 def calculate_shapes_per_class(shapes: list[any]) -> dict[str, int]:
@@ -281,25 +333,24 @@ def calculate_shapes_per_class(shapes: list[any]) -> dict[str, int]:
     return shapes_per_class
 
 
-def calculate_precision(name: str, matched_shapes: list[any], all_classes: dict[str, list[str]]) -> tuple[float, str]:
+def calculate_precision(
+        name: str, matched_shapes: list[any], name_to_class: dict[str, str], class_sets: dict[str, set[str]]
+) -> tuple[float, str]:
     """
     Calculates the precision of a query.
     :param name: Name of the query shape.
     :param matched_shapes: N best-matching shapes.
-    :param all_classes: All classes.
+    :param name_to_class: Dictionary mapping each shape name to its class.
+    :param class_sets: Dictionary mapping each class to the set of its shape names.
     :return: Precision of the query.
     """
     tp = 0
     fp = 0
-    correct_class = None
-    for key, values in all_classes.items():
-        if name in values:
-            correct_class = key
-            break
+    correct_class = name_to_class.get(name)
 
     if correct_class:
         for matched_shape in matched_shapes:
-            if matched_shape in all_classes.get(correct_class, []):
+            if matched_shape in class_sets[correct_class]:
                 tp += 1
             else:
                 fp += 1
@@ -307,32 +358,32 @@ def calculate_precision(name: str, matched_shapes: list[any], all_classes: dict[
     return 0.0, ""
 
 
-def calculate_recall(name: str, matched_shapes: list[any], all_classes: dict[str, list[str]]) -> tuple[float, str]:
+def calculate_recall(
+        name: str, matched_shapes: list[any], name_to_class: dict[str, str], class_sets: dict[str, set[str]]
+) -> tuple[float, str]:
     """
     Calculates the recall of a query.
     :param name: Name of the query shape.
     :param matched_shapes: N best-matching shapes.
-    :param all_classes: All classes.
+    :param name_to_class: Dictionary mapping each shape name to its class.
+    :param class_sets: Dictionary mapping each class to the set of its shape names.
     :return: Recall of the query.
     """
     tp = 0
-    correct_class = None
-    for key, values in all_classes.items():
-        if name in values:
-            correct_class = key
-            break
+    correct_class = name_to_class.get(name)
     if correct_class:
         for matched_shape in matched_shapes:
-            if matched_shape in all_classes.get(correct_class, []):
+            if matched_shape in class_sets[correct_class]:
                 tp += 1
-        fn = len(all_classes.get(correct_class, [])) - tp
+        fn = len(class_sets[correct_class]) - tp
         return tp / (tp + fn) if (tp + fn) > 0 else 0, correct_class
     return 0.0, ""
 
 
 def evaluate_query(
         query_type: str, all_shapes: dict[any], k: int, shapes_per_class: dict[str, int],
-        all_classes: dict[str, list[str]], index: NNDescent, distance_metric: str
+        all_classes: dict[str, list[str]], index: NNDescent, distance_metric: str,
+        descriptor_store: DescriptorStore | None = None
 ) -> tuple[dict[str, float | int], dict[str, float | int], dict[str, float | int]]:
     """
     Evaluates quality of selected query.
@@ -343,6 +394,8 @@ def evaluate_query(
     :param all_classes: All classes.
     :param index: Query index used for the ANN query.
     :param distance_metric: Distance metric to use.
+    :param descriptor_store: Descriptor Store holding the features of all shapes, used by the Custom query. A store
+    that is not attached to the shapes is created if None.
     :return: Precisions, recalls and f1-scores for all classes, as well as for each class separately.
     """
     precisions = {}
@@ -350,24 +403,55 @@ def evaluate_query(
     f1_scores = {}
     average_precision = 0
     average_recall = 0
+
+    # Shape names in the row order of the feature matrices and the ANN index
+    model_names = list(all_shapes.keys())
+
+    # Reverse index of the classes, so finding the class of a shape and checking its members are constant time
+    name_to_class = {}
+    for shape_class, shape_names in all_classes.items():
+        for shape_name in shape_names:
+            name_to_class.setdefault(shape_name, shape_class)
+    class_sets = {shape_class: set(shape_names) for shape_class, shape_names in all_classes.items()}
+
+    # Compute the distances between all shapes at once and partition out the k best matches of every shape
+    all_best_matching_indices = None
+    if query_type == "Custom":
+        if descriptor_store is None:
+            descriptor_store = DescriptorStore(all_shapes, attach_descriptors=False)
+        distance_matrix = get_distance_matrix(descriptor_store, distance_metric)
+        np.fill_diagonal(distance_matrix, np.inf)
+        num_neighbors = max(0, min(k, len(all_shapes) - 1))
+        if num_neighbors > 0:
+            all_best_matching_indices = np.argpartition(distance_matrix, num_neighbors - 1, axis=1)[:, :num_neighbors]
+            best_matching_distances = np.take_along_axis(distance_matrix, all_best_matching_indices, axis=1)
+            order = np.argsort(best_matching_distances, axis=1, kind="stable")
+            all_best_matching_indices = np.take_along_axis(all_best_matching_indices, order, axis=1)
+        else:
+            all_best_matching_indices = np.empty((len(all_shapes), 0), dtype=int)
+
+    # Send all shapes to the ANN index in a single batched query, NaN features are zeroed as they were for the index
+    all_neighbor_indexes = None
+    if query_type == "ANN":
+        query_shapes = np.array([descriptor.get_weighted_normalized_features() for descriptor in all_shapes.values()])
+        all_neighbor_indexes, _ = index.query(np.nan_to_num(query_shapes, nan=0), k=k + 1)
+
     # Query all shapes
-    for name, descriptor in tqdm(all_shapes.items(),
-                                 desc=f"Finding the {k} Best Matching Shapes for each Shape", leave=False):
+    shapes_progress = tqdm(all_shapes.items(), desc=f"Finding the {k} Best Matching Shapes for each Shape", leave=False)
+    for shape_index, (name, descriptor) in enumerate(shapes_progress):
         # Query based on selected query type
         if query_type == "Custom":
-            matching_names, _ = get_best_matching_shapes(
-                descriptor, {key: value for key, value in all_shapes.items() if key != name}, k, distance_metric
-            )
+            matching_names = [model_names[k] for k in all_best_matching_indices[shape_index].tolist()]
         elif query_type == "ANN":
-            neighbor_indexes, _ = index.query(np.array([descriptor.get_weighted_normalized_features()]), k=k + 1)
-            matching_names = [list(all_shapes.keys())[k] for k in neighbor_indexes.flatten().tolist()[1:]]
+            neighbor_indexes = all_neighbor_indexes[shape_index]
+            matching_names = [model_names[k] for k in neighbor_indexes.tolist()[1:]]
         else:
             print(f"No implementation for the query type: {query_type}")
             print("Exiting application...")
             exit()
 
-        precision, correct_class = calculate_precision(name, matching_names, all_classes)
-        recall, _ = calculate_recall(name, matching_names, all_classes)
+        precision, correct_class = calculate_precision(name, matching_names, name_to_class, class_sets)
+        recall, _ = calculate_recall(name, matching_names, name_to_class, class_sets)
         average_precision += precision
         average_recall += recall
 
@@ -1,8 +1,18 @@
 from __future__ import annotations
-import pandas as pd
+import csv
+import os
+import sys
 import trimesh
-from descriptor_extraction import *
-from display_statistics import return_neighbors
+
+# Scripts in this directory are run directly, so the src directory is added to the path to always import the
+# descriptor module as tools.descriptor_extraction. Numba can only load its on-disk cache of the descriptor kernel
+# under the module name that it was compiled under
+src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from tools.descriptor_extraction import *
+from tools.display_statistics import return_neighbors
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
 
@@ -13,27 +23,68 @@ normalized_models_path = os.path.join(os.path.dirname(__file__), '..', '..', 're
 
 THRESHOLD = 500
 
+DATABASE_COLUMNS = ["Model Class", "Model Name", "Surface Area", "Compactness", "Rectangularity", "Diameter",
+                    "Convexity", "Eccentricity", "A3", "D1", "D2", "D3", "D4"]
+
+
+def subdivide(mesh: trimesh.Trimesh, min_vertices: int) -> trimesh.Trimesh | None:
+    """
+    Subdivides a mesh until it has at least a minimum number of vertices.
+    :param mesh: Model mesh.
+    :param min_vertices: Minimum number of vertices.
+    :return: Subdivided mesh, or None if subdividing stops adding vertices before the minimum is reached.
+    """
+    # Subdivide as many times as needed on the raw arrays, before building a single new mesh
+    vertices, faces = mesh.vertices, mesh.faces
+    while len(vertices) < min_vertices:
+        num_vertices = len(vertices)
+        vertices, faces = trimesh.remesh.subdivide(vertices, faces)
+
+        # Meshes without faces can not grow, give up instead of subdividing forever
+        if len(vertices) <= num_vertices:
+            return None
+    return trimesh.Trimesh(vertices, faces)
+
+
+def simplify(mesh: trimesh.Trimesh, target_vertices: int) -> trimesh.Trimesh:
+    """
+    Simplifies a mesh once, with the face count estimated from its current ratio of faces to vertices.
+    :param mesh: Model mesh.
+    :param target_vertices: Target vertices to simplify to.
+    :return: Simplified mesh.
+    """
+    new_face_count = int(target_vertices * (len(mesh.faces) / len(mesh.vertices)))
+    return mesh.simplify_quadratic_decimation(new_face_count)
+
 
 def resample(mesh: trimesh.Trimesh, target_vertices: int) -> trimesh.Trimesh | None:
     """
     Resamples a mesh to a specific target number of vertices.
     :param mesh: Model mesh.
     :param target_vertices: Target vertices to resample to.
-    :return: Resampled mesh.
+    :return: Resampled mesh, or None if it does not end up within the threshold of the target.
     """
-    iterations = 0
-    while len(mesh.vertices) > target_vertices + THRESHOLD or len(mesh.vertices) < target_vertices - THRESHOLD:
-        # If number of vertices is too high, simplify
-        if len(mesh.vertices) > target_vertices + THRESHOLD:
-            new_face_count = target_vertices * (len(mesh.faces) / len(mesh.vertices))
-            mesh = mesh.simplify_quadratic_decimation(new_face_count)
+    # Subdivide first, so that the decimation below usually only has to run once
+    if len(mesh.vertices) < target_vertices - THRESHOLD:
+        mesh = subdivide(mesh, target_vertices - THRESHOLD)
+        if mesh is None:
+            return None
 
-        # If number of vertices is too low, subdivide
+    if len(mesh.vertices) > target_vertices + THRESHOLD:
+        mesh = simplify(mesh, target_vertices)
+
+        # If the simplification undershot, subdivide the result again and simplify once more from the denser mesh
         if len(mesh.vertices) < target_vertices - THRESHOLD:
-            mesh = trimesh.Trimesh(*trimesh.remesh.subdivide(mesh.vertices, mesh.faces))
-        iterations += 1
-        if iterations > 10:
-            return None
+            mesh = subdivide(mesh, target_vertices - THRESHOLD)
+            if mesh is None:
+                return None
+            if len(mesh.vertices) > target_vertices + THRESHOLD:
+                mesh = simplify(mesh, target_vertices)
+
+    # Meshes that could not be brought close enough to the target are skipped
+    num_vertices = len(mesh.vertices)
+    if num_vertices > target_vertices + THRESHOLD or num_vertices < target_vertices - THRESHOLD:
+        return None
     return mesh
 
 
@@ -43,30 +94,26 @@ def align_to_largest_extent_component(mesh: Trimesh) -> Trimesh:
     :param mesh: Mesh that will be aligned.
     :return: Aligned mesh.
     """
+    vertices = mesh.vertices
     extents = mesh.extents
-    max_extent_direction = mesh.vertices.max(axis=0) - mesh.vertices.min(axis=0)
+    max_extent_direction = vertices.max(axis=0) - vertices.min(axis=0)
     major_axis_index = np.argmax(extents)
     major_axis_sign = np.sign(max_extent_direction[major_axis_index])
 
     # Ensure the major axis points in the positive direction
     if major_axis_sign < 0:
-        mesh.vertices[:, major_axis_index] *= -1  # This flips the mesh along the major axis
+        vertices[:, major_axis_index] *= -1  # This flips the mesh along the major axis
 
     return mesh
 
 
-def align_mesh_axes(eig_vectors: np.ndarray, eig_values: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+def align_mesh_axes(eig_vectors: np.ndarray, vertices: np.ndarray) -> np.ndarray:
     """
-    Calculates aligned mesh eigenvectors based on the eigenvalues and the extents of the mesh vertices.
-    :param eig_vectors: Mesh eigenvectors.
-    :param eig_values: Mesh eigenvalues.
+    Calculates aligned mesh eigenvectors based on the extents of the mesh vertices.
+    :param eig_vectors: Mesh eigenvectors, sorted from major to minor eigenvalue.
     :param vertices: Mesh vertices.
     :return: Aligned eigenvectors.
     """
-    # Sort eigenvalues and eigenvectors by the magnitude of the eigenvalues (major to minor)
-    sort_idx = np.argsort(-eig_values)
-    eig_vectors = eig_vectors[:, sort_idx]
-
     # Project the vertices onto the eigenvectors to find their extents
     projected_vertices = vertices @ eig_vectors
     min_extents = projected_vertices.min(axis=0)
@@ -96,24 +143,60 @@ def align_mesh(mesh: Trimesh, eig_vectors: np.ndarray) -> Trimesh:
     :return: Aligned mesh.
     """
     # Apply the rotation to align the mesh with the new axes
-    mesh.vertices = mesh.vertices @ eig_vectors
+    vertices = mesh.vertices @ eig_vectors
 
     # Ensure the axes are pointing in the positive direction based on the vertices' positions
-    for i in range(3):
-        if mesh.vertices[:, i].mean() < 0:
-            mesh.vertices[:, i] = -mesh.vertices[:, i]
+    signs = np.where(vertices.mean(axis=0) < 0, -1.0, 1.0)
+    mesh.vertices = vertices * signs
 
     return mesh
 
 
+def get_database_row(descriptor: ShapeDescriptors) -> list[any]:
+    """
+    Converts the descriptors of a shape to a database row, with the values in the order of DATABASE_COLUMNS.
+    :param descriptor: Shape descriptors.
+    :return: Database row.
+    """
+    return [
+        descriptor.model_class,
+        descriptor.model_name,
+        round(descriptor.surface_area, 3),
+        round(descriptor.compactness, 3),
+        round(descriptor.rectangularity, 3),
+        round(descriptor.diameter, 3),
+        round(descriptor.convexity, 3),
+        round(descriptor.eccentricity, 3),
+        np.round(descriptor.A3, 3).tolist(),
+        np.round(descriptor.D1, 3).tolist(),
+        np.round(descriptor.D2, 3).tolist(),
+        np.round(descriptor.D3, 3).tolist(),
+        np.round(descriptor.D4, 3).tolist(),
+    ]
+
+
+def open_database_file():
+    """
+    Opens the database file for writing, falling back to the other output directories if it cannot be created.
+    :return: Opened database file.
+    """
+    try:
+        return open(database_path, 'w', newline='')
+    except OSError:
+        try:
+            return open(os.path.join('tools', 'outputs', 'database2.csv'), 'w', newline='')
+        except OSError:
+            return open(os.path.join('outputs', 'database2.csv'), 'w', newline='')
+
+
 def normalize_mesh(args):
     """
-    Processes a mesh based on the 5-step normalization process.
+    Loads a mesh and processes it based on the 5-step normalization process.
+    :return: Database row of the normalized mesh, or None if it could not be resampled.
     """
-    m, target_faces = args
-    model_class = m[1]
-    model_name = m[2]
-    mesh = m[0]
+    path, target_faces = args
+    # Load the mesh in the worker, so that only the path and the resulting row are sent between processes
+    mesh, model_class, model_name = load_model(path)
 
     # Step 1: Resample
     mesh.process()
@@ -126,11 +209,13 @@ def normalize_mesh(args):
         mesh.apply_translation(-barycenter)
 
         # Step 3: Pose (alignment)
-        covariance_matrix = np.cov(mesh.vertices.T)
-        eig_values, eig_vectors = np.linalg.eig(covariance_matrix)
-        sorted_indices = np.argsort(-eig_values)
-        eig_vectors = eig_vectors[:, sorted_indices]
-        aligned_eig_vectors = align_mesh_axes(eig_vectors, eig_values, mesh.vertices)
+        vertices = mesh.vertices
+        covariance_matrix = np.cov(vertices.T)
+        # The covariance matrix is symmetric, so the symmetric solver gives real eigenpairs in ascending order,
+        # reversing the columns sorts the eigenvectors from major to minor
+        eig_values, eig_vectors = np.linalg.eigh(covariance_matrix)
+        eig_vectors = eig_vectors[:, ::-1]
+        aligned_eig_vectors = align_mesh_axes(eig_vectors, vertices)
         mesh = align_mesh(mesh, aligned_eig_vectors)
 
         # Step 4: Scale
@@ -149,7 +234,8 @@ def normalize_mesh(args):
         mesh_path = os.path.join(normalized_output_path, f"{base_model_name}.obj")
         mesh.export(mesh_path, file_type="obj")
 
-        return descriptors
+        # Only send the row back to the main process, the descriptors also hold the mesh
+        return get_database_row(descriptors)
 
     return None
 
@@ -157,8 +243,8 @@ def normalize_mesh(args):
 def load_model(path: tuple[str, str, str]) -> tuple[trimesh.Trimesh, str, str]:
     """
     Load model from path.
-    :param path: Tuple containing the model's path, name and class.
-    :return: Tuple containing the model's mesh, name and class.
+    :param path: Tuple containing the model's path, class and name.
+    :return: Tuple containing the model's mesh, class and name.
     """
     mesh = trimesh.load_mesh(path[0])
     return mesh, path[1], path[2]
@@ -180,53 +266,29 @@ def main():
                 path = os.path.join(models_path, model_class, file)
                 paths_to_load.append((path, model_class, file))
 
-    # Use multiprocessing to parallelize the loading
-    with Pool(processes=cpu_count()) as pool:
-        meshes = pool.map(load_model, paths_to_load)
-
+    # Only the average model has to be loaded up front to find the target number of vertices
     average_model, _ = return_neighbors()
-    average_mesh = next((m[0] for m in meshes if m[2] == average_model["Shape Name"]), None)
+    average_path = next(path for path in paths_to_load if path[2] == average_model["Shape Name"])
+    average_mesh, _, _ = load_model(average_path)
 
     target_faces = len(average_mesh.vertices)
 
-    # Use multiprocessing to parallelize the processing
-    with Pool(processes=cpu_count()) as pool:
-        all_descriptors = list(
-            tqdm(pool.imap_unordered(normalize_mesh, [(m, target_faces) for m in meshes]), total=len(meshes)))
-    data_list = []
-
-    # Remove all None elements
-    all_descriptors = [descriptor for descriptor in all_descriptors if descriptor]
-
-    for descriptor in tqdm(all_descriptors, desc="Saving Descriptors for all Shapes", leave=False):
-        data = {
-            "Model Class": descriptor.model_class,
-            "Model Name": descriptor.model_name,
-            "Surface Area": round(descriptor.surface_area, 3),
-            "Compactness": round(descriptor.compactness, 3),
-            "Rectangularity": round(descriptor.rectangularity, 3),
-            "Diameter": round(descriptor.diameter, 3),
-            "Convexity": round(descriptor.convexity, 3),
-            "Eccentricity": round(descriptor.eccentricity, 3),
-            "A3": [round(x, 3) for x in descriptor.A3],
-            "D1": [round(x, 3) for x in descriptor.D1],
-            "D2": [round(x, 3) for x in descriptor.D2],
-            "D3": [round(x, 3) for x in descriptor.D3],
-            "D4": [round(x, 3) for x in descriptor.D4],
-        }
-        data_list.append(data)
-
-    df = pd.DataFrame(data_list)
-
-    try:
-        df.to_csv(database_path, index=False, sep=';')
-    except OSError:
-        try:
-            path = os.path.join('tools', 'outputs', 'database2.csv')
-            df.to_csv(path, index=False, sep=';')
-        except OSError:
-            path = os.path.join('outputs', 'database2.csv')
-            df.to_csv(path, index=False, sep=';')
+    # Use multiprocessing to parallelize the loading and processing, rows are written as soon as a worker finishes
+    # a mesh. Sending the paths in chunks reduces the communication overhead between the processes
+    processes = cpu_count()
+    chunksize = max(1, len(paths_to_load) // (4 * processes))
+    # Every worker gets its own random generator for the descriptor sampling
+    with open_database_file() as database_file, \
+            Pool(processes=processes, initializer=seed_worker_random_generator) as pool:
+        writer = csv.writer(database_file, delimiter=';', lineterminator=os.linesep)
+        writer.writerow(DATABASE_COLUMNS)
+
+        tasks = [(path, target_faces) for path in paths_to_load]
+        for row in tqdm(pool.imap_unordered(normalize_mesh, tasks, chunksize=chunksize), total=len(tasks),
+                        desc="Saving Descriptors for all Shapes"):
+            # Skip the meshes that could not be resampled
+            if row:
+                writer.writerow(row)
 
 
 if __name__ == '__main__':
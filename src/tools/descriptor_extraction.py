@@ -1,6 +1,6 @@
+from __future__ import annotations
 import numpy as np
 from numba import njit
-import matplotlib.pyplot as plt
 import os
 import pandas as pd
 from trimesh import Trimesh
@@ -9,10 +9,20 @@ from trimesh import Trimesh
 output_dir1 = "tools/outputs/histograms/descriptors"
 output_dir2 = "src/tools/outputs/histograms/descriptors"
 
-np.random.seed(42)
+rng = np.random.default_rng(42)
 
 SAMPLE_SIZE = 100
 BIN_SIZE = 10
+SINGLE_FEATURE_WEIGHT = 0.015
+
+
+def seed_worker_random_generator() -> None:
+    """
+    Gives the current process its own random generator, used as the initializer of worker pools.
+    Forked workers would otherwise all continue from the same copy of the generator state.
+    """
+    global rng
+    rng = np.random.default_rng([42, os.getpid()])
 
 
 def calculate_mesh_volume(mesh: Trimesh) -> float:
@@ -25,18 +35,68 @@ def calculate_mesh_volume(mesh: Trimesh) -> float:
     if not mesh.is_watertight:
         mesh.fill_holes()
 
-    # Calculate the volume using the watertight mesh
-    reference_point = mesh.centroid
-    volumes = []
-    for face in mesh.faces:
-        v0, v1, v2 = mesh.vertices[face]
-        tetra_volume = np.dot(reference_point - v0, np.cross(v1 - v0, v2 - v0)) / 6.0
-        volumes.append(tetra_volume)
-
-    volume = np.abs(sum(volumes))
+    # Calculate the volume using the watertight mesh, trimesh sums the signed tetrahedron volumes of all faces
+    volume = np.abs(mesh.volume)
     return volume
 
 
+# Cached on disk, so that the worker processes load the compiled kernel instead of each compiling it on their first
+# call. This only works because the module is always imported as tools.descriptor_extraction, numba cannot load the
+# cache under a different module name. Fastmath is limited to the flags that keep NaN and infinity semantics, the
+# degenerate A3 samples are marked with NaN
+@njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'reassoc'})
+def sample_shape_properties(vertices: np.ndarray, barycenter: np.ndarray, indices: np.ndarray) -> tuple[np.ndarray, ...]:
+    """
+    Computes the samples of all shape property descriptors in a single pass.
+    :param vertices: Mesh vertices.
+    :param barycenter: Mesh barycenter.
+    :param indices: Array of shape (num_samples, 4) with the random vertices of every sample, A3 and D3 use the first
+    3, D2 the first 2 and D1 the first vertex.
+    :return: Tuple of the A3 angles (NaN for degenerate samples), D1 distances, D2 distances, D3 square roots of areas
+    and D4 cube roots of volumes.
+    """
+    num_samples = indices.shape[0]
+    angles = np.empty(num_samples)
+    barycenter_distances = np.empty(num_samples)
+    vertex_distances = np.empty(num_samples)
+    areas = np.empty(num_samples)
+    volumes = np.empty(num_samples)
+
+    for i in range(num_samples):
+        A = vertices[indices[i, 0]]
+        B = vertices[indices[i, 1]]
+        C = vertices[indices[i, 2]]
+        D = vertices[indices[i, 3]]
+
+        # A3: angle between 3 random vertices
+        BA = A - B
+        BC = C - B
+        side_lengths = np.sqrt(np.dot(BA, BA)) * np.sqrt(np.dot(BC, BC))
+        if side_lengths > 0:
+            angles[i] = np.arccos(min(max(np.dot(BA, BC) / side_lengths, -1.0), 1.0))
+        else:
+            angles[i] = np.nan
+
+        # D1: distance between the barycenter and a random vertex
+        AO = A - barycenter
+        barycenter_distances[i] = np.sqrt(np.dot(AO, AO))
+
+        # D2: distance between 2 random vertices
+        AB = B - A
+        vertex_distances[i] = np.sqrt(np.dot(AB, AB))
+
+        # D3: square root of the area of the triangle given by 3 random vertices, half the norm of the cross product
+        AC = C - A
+        normal = np.cross(AB, AC)
+        areas[i] = np.sqrt(np.sqrt(np.dot(normal, normal)) / 2)
+
+        # D4: cube root of the volume of the tetrahedron formed by 4 random vertices
+        AD = D - A
+        volumes[i] = np.cbrt(abs(np.dot(AB, np.cross(AC, AD))) / 6)
+
+    return angles, barycenter_distances, vertex_distances, areas, volumes
+
+
 class ShapeDescriptors:
     """
     Represents the descriptors of a shape.
@@ -71,6 +131,10 @@ class ShapeDescriptors:
         self.sample_size = SAMPLE_SIZE
         self.bin_size = BIN_SIZE
 
+        # Set when the features are stored in a DescriptorStore, the cached features are then views into its rows
+        self.store = None
+        self.store_index = None
+
     @classmethod
     def from_csv_row(cls, row, mesh):
         model_class = row['Model Class'].item()
@@ -117,16 +181,16 @@ class ShapeDescriptors:
 
         volume = calculate_mesh_volume(mesh)
 
+        # Computing the volume can fill holes in the mesh, so the shared quantities are only computed afterwards
+        convex_hull = mesh.convex_hull
+        barycenter = mesh.centroid
+
         compactness = cls.compute_compactness(mesh, volume)
         rectangularity = cls.compute_rectangularity(mesh, volume)
-        diameter = cls.compute_diameter(mesh.convex_hull.vertices)
-        convexity = cls.compute_convexity(mesh, volume)
+        diameter = cls.compute_diameter(convex_hull.vertices)
+        convexity = cls.compute_convexity(mesh, volume, convex_hull.volume)
         eccentricity = cls.compute_eccentricity(mesh)
-        A3 = cls.compute_A3(mesh, SAMPLE_SIZE)
-        D1 = cls.compute_D1(mesh, SAMPLE_SIZE)
-        D2 = cls.compute_D2(mesh, SAMPLE_SIZE)
-        D3 = cls.compute_D3(mesh, SAMPLE_SIZE)
-        D4 = cls.compute_D4(mesh, SAMPLE_SIZE)
+        A3, D1, D2, D3, D4 = cls.compute_shape_property_descriptors(mesh, SAMPLE_SIZE, barycenter)
 
         return cls(
             mesh=mesh,
@@ -165,27 +229,31 @@ class ShapeDescriptors:
         return volume / obb_volume
 
     @staticmethod
-    @njit
     def compute_diameter(vertices: np.ndarray) -> float:
         """
         Calculates the mesh diameter.
         :param vertices: Mesh vertices.
         :return: Mesh diameter.
         """
-        diameter = 0
-        for i in range(len(vertices)):
-            for j in range(i + 1, len(vertices)):
-                dist = np.linalg.norm(vertices[i] - vertices[j])
-                diameter = max(diameter, dist)
-        return diameter
+        # Single precision halves the memory traffic of the GEMM, centering the vertices first keeps the
+        # cancellation in the expansion below small compared to the diameter
+        vertices = np.ascontiguousarray(vertices - vertices.mean(axis=0), dtype=np.float32)
 
-    def compute_convexity(mesh, volume: float) -> float:
+        # All squared pairwise distances at once as |a|^2 + |b|^2 - 2 a.b, the dot products come from a single GEMM
+        squared_norms = np.einsum('ij,ij->i', vertices, vertices)
+        squared_distances = np.add.outer(squared_norms, squared_norms) - 2 * (vertices @ vertices.T)
+        return float(np.sqrt(max(squared_distances.max(), 0.0))) if len(vertices) > 1 else 0
+
+    def compute_convexity(mesh, volume: float, hull_volume: float | None = None) -> float:
         """
         Calculates the mesh convexity.
         :param volume: Mesh volume.
+        :param hull_volume: Volume of the mesh's convex hull, computed from the mesh if None.
         :return: Mesh convexity.
         """
-        return volume / mesh.convex_hull.volume
+        if hull_volume is None:
+            hull_volume = mesh.convex_hull.volume
+        return volume / hull_volume
 
     def compute_eccentricity(mesh) -> float:
         """
@@ -193,252 +261,104 @@ class ShapeDescriptors:
         :return: Mesh eccentricity.
         """
         covariance_matrix = np.cov(np.transpose(mesh.vertices))
-        eigenvalues = np.linalg.eigvals(covariance_matrix)
-        return max(eigenvalues) / min(eigenvalues)
+        # Eigenvalues of the symmetric covariance matrix are real and returned in ascending order
+        eigenvalues = np.linalg.eigvalsh(covariance_matrix)
+        return eigenvalues[-1] / eigenvalues[0]
 
-    def compute_A3(mesh, num_samples: int) -> float:
+    def compute_shape_property_descriptors(
+            mesh, num_samples: int, barycenter: np.ndarray | None = None
+    ) -> tuple[np.ndarray, ...]:
         """
-        Calculates the A3 descriptor.
+        Calculates the A3, D1, D2, D3 and D4 descriptors at once, from the same random vertex samples.
         :param num_samples: Number of random samples to use.
-        :return: A3 descriptor.
-        """
-        angles = []
-        vertices = mesh.vertices
-        for _ in range(num_samples):
-            A, B, C = vertices[np.random.choice(vertices.shape[0], 3, replace=False)]
-            BA = A - B
-            BC = C - B
-            cosine_angle = np.dot(BA, BC) / (np.linalg.norm(BA) * np.linalg.norm(BC))
-            angle = np.arccos(np.clip(cosine_angle, -1.0, 1.0))
-            angles.append(angle)
-
-        histogram, bin_edges = np.histogram(angles, bins=BIN_SIZE, range=(0, np.pi))
-        a3 = [x / np.sum(histogram) for x in histogram]
-        return a3
-
-    def save_A3_histogram_image(self) -> None:
-        """
-        Saves the histogram of the A3 descriptor.
-        """
-        histogram = self.A3
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bin_edges = np.linspace(0, np.pi, len(histogram) + 1)
+        :param barycenter: Mesh barycenter, computed from the mesh if None.
+        :return: Tuple of the A3, D1, D2, D3 and D4 descriptors.
+        """
+        vertices = np.ascontiguousarray(mesh.vertices, dtype=np.float64)
+        # Copied because the cached centroid of trimesh is read-only, which would compile a separate kernel
+        barycenter = np.array(mesh.centroid if barycenter is None else barycenter, dtype=np.float64)
+        indices = rng.integers(len(vertices), size=(num_samples, 4), dtype=np.int64)
+
+        angles, barycenter_distances, vertex_distances, areas, volumes = sample_shape_properties(
+            vertices, barycenter, indices)
+
+        descriptors = []
+        for samples, samples_range in [(angles[~np.isnan(angles)], (0, np.pi)), (barycenter_distances, None),
+                                       (vertex_distances, None), (areas, None), (volumes, None)]:
+            histogram, bin_edges = np.histogram(samples, bins=BIN_SIZE, range=samples_range)
+            descriptor = histogram.astype(np.float64)
+            descriptor /= descriptor.sum()
+            descriptors.append(descriptor)
+        return tuple(descriptors)
+
+    def save_histogram_image(self, histogram: np.ndarray, prefix: str, x_label: str, title: str,
+                             x_max: float = 1.0) -> None:
+        """
+        Saves the image of one of the histogram descriptors.
+        :param histogram: Histogram values.
+        :param prefix: Descriptor name, used as the prefix of the file name.
+        :param x_label: Label of the x-axis.
+        :param title: Title of the plot.
+        :param x_max: Upper bound of the x-axis. The distance histograms are binned over the range of their own
+                      samples, so by default the bins are drawn relative to that range.
+        """
+        # Imported here so that the worker processes, which never save images, do not have to load matplotlib.
+        # A figure that is not managed by pyplot does not need a GUI backend
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
+        bin_edges = np.linspace(0, x_max, len(histogram) + 1)
         bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        ax.bar(bin_centers, histogram, width=np.pi / len(histogram), align='center', edgecolor='black')
-        ax.set_xlabel('Angle (radians)')
+        ax.bar(bin_centers, histogram, width=x_max / len(histogram), align='center', edgecolor='black')
+        ax.set_xlabel(x_label)
         ax.set_ylabel('Frequency')
-        ax.set_title('Angle Between 3 Random Vertices')
-        ax.set_xlim(0, np.pi)
+        ax.set_title(title)
+        ax.set_xlim(0, x_max)
         ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
+        fig.tight_layout()
 
         # Save the figure directly to the desired path
-        filename = f"A3_{self.model_class}_{self.model_name}.png"
+        filename = f"{prefix}_{self.model_class}_{self.model_name}.png"
 
         try:
             output_path = os.path.join(output_dir1, filename)
         except FileNotFoundError:
             output_path = os.path.join(output_dir2, filename)
 
-        plt.savefig(output_path, format="png")
-        plt.close(fig)
+        fig.savefig(output_path, format="png")
 
-    def compute_D1(mesh, num_samples: int) -> float:
+    def save_A3_histogram_image(self) -> None:
         """
-        Calculates the D1 descriptor.
-        :param num_samples: Number of random samples to use.
-        :return: D1 descriptor.
+        Saves the histogram of the A3 descriptor.
         """
-        barycenter = mesh.centroid
-
-        distances = []
-        vertices = mesh.vertices
-        for _ in range(num_samples):
-            # Sample a random vertex
-            vertex = vertices[np.random.choice(vertices.shape[0])]
-            # Compute the distance
-            distance = np.linalg.norm(vertex - barycenter)
-            distances.append(distance)
-        histogram, bin_edges = np.histogram(distances, bins=BIN_SIZE)
-        d1 = [x / np.sum(histogram) for x in histogram]
-        return d1
+        self.save_histogram_image(self.A3, 'A3', 'Angle (radians)', 'Angle Between 3 Random Vertices', np.pi)
 
     def save_D1_histogram_image(self) -> None:
         """
         Saves the histogram of the D1 descriptor.
         """
-        histogram = self.D1
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bin_edges = np.linspace(0, np.pi, len(histogram) + 1)
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        ax.bar(bin_centers, histogram, width=np.pi / len(histogram), align='center', edgecolor='black')
-        ax.set_xlabel('Distance')
-        ax.set_ylabel('Frequency')
-        ax.set_title('Distance Between Barycenter and Eandom Vertex')
-        ax.set_xlim(0, np.pi)
-        ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-
-        # Save the figure directly to the desired path
-        filename = f"D1_{self.model_class}_{self.model_name}.png"
-        try:
-            output_path = os.path.join(output_dir1, filename)
-        except FileNotFoundError:
-            output_path = os.path.join(output_dir2, filename)
-        plt.savefig(output_path, format="png")
-        plt.close(fig)
-
-    def compute_D2(mesh, num_samples: int) -> float:
-        """
-        Calculates the D2 descriptor.
-        :param num_samples: Number of random samples to use.
-        :return: D2 descriptor.
-        """
-        distances = []
-        vertices = mesh.vertices
-        for _ in range(num_samples):
-            # Sample two distinct random vertices
-            vertex1, vertex2 = vertices[np.random.choice(vertices.shape[0], 2, replace=False)]
-
-            # Compute the distance
-            distance = np.linalg.norm(vertex1 - vertex2)
-            distances.append(distance)
-        histogram, bin_edges = np.histogram(distances, bins=BIN_SIZE)
-        d2 = [x / np.sum(histogram) for x in histogram]
-        return d2
+        self.save_histogram_image(self.D1, 'D1', 'Distance', 'Distance Between Barycenter and Random Vertex')
 
     def save_D2_histogram_image(self) -> None:
         """
         Saves the histogram of the D2 descriptor.
         """
-        histogram = self.D2
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bin_edges = np.linspace(0, np.pi, len(histogram) + 1)
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        ax.bar(bin_centers, histogram, width=np.pi / len(histogram), align='center', edgecolor='black')
-        ax.set_xlabel('Distance')
-        ax.set_ylabel('Frequency')
-        ax.set_title('Distance Between 2 Random Vertices')
-        ax.set_xlim(0, np.pi)
-        ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-
-        # Save the figure directly to the desired path
-        filename = f"D2_{self.model_class}_{self.model_name}.png"
-        try:
-            output_path = os.path.join(output_dir1, filename)
-        except FileNotFoundError:
-            output_path = os.path.join(output_dir2, filename)
-        plt.savefig(output_path, format="png")
-        plt.close(fig)
-
-    def compute_D3(mesh, num_samples: int) -> float:
-        """
-        Calculates the D3 descriptor.
-        :param num_samples: Number of random samples to use.
-        :return: D3 descriptor.
-        """
-        areas = []
-        vertices = mesh.vertices
-        for _ in range(num_samples):
-            # Sample three distinct random vertices
-            A, B, C = vertices[np.random.choice(vertices.shape[0], 3, replace=False)]
-
-            # Compute the lengths of the sides of the triangle
-            a = round(np.linalg.norm(B - C), 3)
-            b = round(np.linalg.norm(A - C), 3)
-            c = round(np.linalg.norm(A - B), 3)
-
-            # Compute the semi-perimeter
-            s = round(((a + b + c) / 2), 3)
-
-            # Compute the area using Heron's formula
-            area = round(np.sqrt(np.abs(s * (s - a) * (s - b) * (s - c))), 3)
-            areas.append(np.sqrt(area))
-            try:
-                histogram, bin_edges = np.histogram(areas, bins=BIN_SIZE)
-            except ValueError:
-                raise ValueError
-        d3 = [x / np.sum(histogram) for x in histogram]
-        return d3
+        self.save_histogram_image(self.D2, 'D2', 'Distance', 'Distance Between 2 Random Vertices')
 
     def save_D3_histogram_image(self) -> None:
         """
         Saves the histogram of the D3 descriptor.
         """
-        histogram = self.D3
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bin_edges = np.linspace(0, np.pi, len(histogram) + 1)
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        ax.bar(bin_centers, histogram, width=np.pi / len(histogram), align='center', edgecolor='black')
-        ax.set_xlabel('Square Root of Area')
-        ax.set_ylabel('Frequency')
-        ax.set_title('Square Root of Area of Triangle Given by 3 Random Vertices')
-        ax.set_xlim(0, np.pi)
-        ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-
-        # Save the figure directly to the desired path
-        filename = f"D3_{self.model_class}_{self.model_name}.png"
-        try:
-            output_path = os.path.join(output_dir1, filename)
-        except FileNotFoundError:
-            output_path = os.path.join(output_dir2, filename)
-        plt.savefig(output_path, format="png")
-        plt.close(fig)
-
-    def compute_D4(mesh, num_samples: int) -> float:
-        """
-        Calculates the D4 descriptor.
-        :param num_samples: Number of random samples to use.
-        :return: D4 descriptor.
-        """
-        volumes = []
-        vertices = mesh.vertices
-        for _ in range(num_samples):
-            # Sample four distinct random vertices
-            A, B, C, D = vertices[np.random.choice(vertices.shape[0], 4, replace=False)]
-
-            # Compute the volume of the tetrahedron
-            AB = B - A
-            AC = C - A
-            AD = D - A
-            volume = np.abs(np.dot(AB, np.cross(AC, AD))) / 6
-
-            volumes.append(np.cbrt(volume))
-        histogram, bin_edges = np.histogram(volumes, bins=BIN_SIZE)
-        d4 = [x / np.sum(histogram) for x in histogram]
-        return d4
+        self.save_histogram_image(self.D3, 'D3', 'Square Root of Area',
+                                  'Square Root of Area of Triangle Given by 3 Random Vertices')
 
     def save_D4_histogram_image(self) -> None:
         """
         Saves the histogram of the D4 descriptor.
         """
-        histogram = self.D4
-
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bin_edges = np.linspace(0, np.pi, len(histogram) + 1)
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-        ax.bar(bin_centers, histogram, width=np.pi / len(histogram), align='center', edgecolor='black')
-        ax.set_xlabel('Cube Root of Area')
-        ax.set_ylabel('Frequency')
-        ax.set_title('Cube Root of Volume of Tetrahedron Formed by 4 Random Vertices')
-        ax.set_xlim(0, np.pi)
-        ax.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.tight_layout()
-
-        # Save the figure directly to the desired path
-        filename = f"D4_{self.model_class}_{self.model_name}.png"
-        try:
-            output_path = os.path.join(output_dir1, filename)
-        except FileNotFoundError:
-            output_path = os.path.join(output_dir2, filename)
-        plt.savefig(output_path, format="png")
-        plt.close(fig)
+        self.save_histogram_image(self.D4, 'D4', 'Cube Root of Area',
+                                  'Cube Root of Volume of Tetrahedron Formed by 4 Random Vertices')
 
     def get_single_features(self) -> list[float]:
         """
@@ -457,12 +377,12 @@ class ShapeDescriptors:
         Returns the weighted normalized single and histogram features.
         :return: Weighted normalized single and histogram features.
         """
-        return_list = [self.surface_area_normalized * 0.015,
-                       self.compactness_normalized * 0.015,
-                       self.rectangularity_normalized * 0.015,
-                       self.diameter_normalized * 0.015,
-                       self.convexity_normalized * 0.015,
-                       self.eccentricity_normalized * 0.015,
+        return_list = [self.surface_area_normalized * SINGLE_FEATURE_WEIGHT,
+                       self.compactness_normalized * SINGLE_FEATURE_WEIGHT,
+                       self.rectangularity_normalized * SINGLE_FEATURE_WEIGHT,
+                       self.diameter_normalized * SINGLE_FEATURE_WEIGHT,
+                       self.convexity_normalized * SINGLE_FEATURE_WEIGHT,
+                       self.eccentricity_normalized * SINGLE_FEATURE_WEIGHT,
                        ]
 
         return_list.extend([x * 0.225 for x in self.A3])
@@ -501,10 +421,11 @@ class ShapeDescriptors:
 
         return return_list
 
-    def normalize_single_features(self, updated_features: np.ndarray) -> None:
+    def normalize_single_features(self, updated_features: np.ndarray, update_cache: bool = True) -> None:
         """
         Normalizes the shape's single features.
         :param updated_features: Normalized single features.
+        :param update_cache: Whether to update the cached features, can be skipped if the store updates them instead.
         """
         self.surface_area_normalized = updated_features[0]
         self.compactness_normalized = updated_features[1]
@@ -512,3 +433,137 @@ class ShapeDescriptors:
         self.diameter_normalized = updated_features[3]
         self.convexity_normalized = updated_features[4]
         self.eccentricity_normalized = updated_features[5]
+        if update_cache:
+            self.update_cached_features()
+
+    def get_cached_features(self) -> dict[str, np.ndarray]:
+        """
+        Computes the normalized features as float32 arrays, along with their cumulative sums which are used by the
+        Earth Mover's Distance and their unit-length versions which are used by the Cosine distance.
+        :return: Dictionary where the keys are the cached feature attributes and the values are the features.
+        """
+        single_features = np.asarray(self.get_normalized_single_features(), dtype=np.float32)
+        histogram_features = np.asarray(self.get_normalized_histogram_features(), dtype=np.float32)
+        weighted_features = np.asarray(self.get_weighted_normalized_features(), dtype=np.float32)
+
+        return {
+            "cached_single_features": single_features,
+            "cached_histogram_features": histogram_features,
+            "cached_weighted_features": weighted_features,
+            "single_cumsum": np.cumsum(single_features),
+            "histogram_cumsum": np.cumsum(histogram_features),
+            "weighted_cumsum": np.cumsum(weighted_features),
+            "single_unit": single_features / (np.linalg.norm(single_features) + 1e-12),
+            "histogram_unit": histogram_features / (np.linalg.norm(histogram_features) + 1e-12),
+            "weighted_unit": weighted_features / (np.linalg.norm(weighted_features) + 1e-12),
+        }
+
+    def update_cached_features(self) -> None:
+        """
+        Updates the row of this shape in its Descriptor Store, does nothing if the shape is not in a store.
+        """
+        if self.store is None:
+            return
+
+        # Write through the views, so that the matrices of the store stay up to date
+        for attribute, features in self.get_cached_features().items():
+            getattr(self, attribute)[...] = features
+
+    def attach_to_store(self, store: DescriptorStore, store_index: int) -> None:
+        """
+        Replaces the cached features by views into a row of a Descriptor Store.
+        :param store: Descriptor Store holding the features of this shape.
+        :param store_index: Row of this shape in the store.
+        """
+        self.store = store
+        self.store_index = store_index
+        for key, attribute in DescriptorStore.FEATURE_ATTRIBUTES.items():
+            setattr(self, attribute, store[key][store_index])
+
+
+class DescriptorStore:
+    """
+    Stores the features of a set of shapes as contiguous float32 matrices with one row per shape, so they can be
+    queried in a single pass. The Shape Descriptors keep views into the row of their shape.
+    """
+    # Feature matrices of the store and the Shape Descriptor attributes that hold their rows. Cosine distances are
+    # computed on the unit-length versions and Earth Mover's Distances on the cumulative sums.
+    FEATURE_ATTRIBUTES = {
+        "single": "cached_single_features",
+        "histogram": "cached_histogram_features",
+        "weighted": "cached_weighted_features",
+        "single_cumsum": "single_cumsum",
+        "histogram_cumsum": "histogram_cumsum",
+        "weighted_cumsum": "weighted_cumsum",
+        "single_unit": "single_unit",
+        "histogram_unit": "histogram_unit",
+        "weighted_unit": "weighted_unit",
+    }
+
+    def __init__(self, descriptors: dict[str, ShapeDescriptors], attach_descriptors: bool = True) -> None:
+        """
+        Constructor.
+        :param descriptors: Dictionary where the keys are the shape names and the values are their Shape Descriptors.
+        :param attach_descriptors: Whether the Shape Descriptors should keep views into their rows. A store that is
+        not attached leaves the Shape Descriptors untouched, but does not pick up later changes to their features.
+        """
+        self.descriptors = list(descriptors.values())
+        self.model_names = list(descriptors.keys())
+        self.model_indices = {name: i for i, name in enumerate(self.model_names)}
+
+        all_cached_features = [descriptor.get_cached_features() for descriptor in self.descriptors]
+        self.matrices = {}
+        for key, attribute in self.FEATURE_ATTRIBUTES.items():
+            self.matrices[key] = np.stack([cached_features[attribute] for cached_features in all_cached_features])
+
+        if attach_descriptors:
+            for i, descriptor in enumerate(self.descriptors):
+                descriptor.attach_to_store(self, i)
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        """
+        Returns one of the feature matrices.
+        :param key: Name of the feature matrix (one of the FEATURE_ATTRIBUTES keys).
+        :return: Feature matrix with one row per shape.
+        """
+        return self.matrices[key]
+
+    def __len__(self) -> int:
+        """
+        Returns the number of shapes in the store.
+        :return: Number of shapes.
+        """
+        return len(self.descriptors)
+
+    def normalize_single_features(self) -> None:
+        """
+        Standardizes the single features of all shapes at once.
+        """
+        features_array = np.array([descriptor.get_single_features() for descriptor in self.descriptors])
+
+        mean = np.mean(features_array, axis=0)
+        std = np.std(features_array, axis=0)
+
+        # Avoid division by zero in case of a zero standard deviation
+        std[std == 0] = 1
+
+        standardized_features = (features_array - mean) / std
+
+        for descriptor, standardized_feature in zip(self.descriptors, standardized_features):
+            descriptor.normalize_single_features(standardized_feature, update_cache=False)
+
+        # Update all rows at once, the single features come first in the weighted features
+        num_single_features = standardized_features.shape[1]
+        self.matrices["single"][...] = standardized_features
+        self.matrices["weighted"][:, :num_single_features] = standardized_features * SINGLE_FEATURE_WEIGHT
+        self.update_derived_features()
+
+    def update_derived_features(self) -> None:
+        """
+        Recomputes the cumulative sums and unit-length versions of all feature matrices.
+        """
+        for key in ("single", "histogram", "weighted"):
+            features = self.matrices[key]
+            np.cumsum(features, axis=1, out=self.matrices[key + "_cumsum"])
+            norms = np.linalg.norm(features, axis=1, keepdims=True) + np.float32(1e-12)
+            np.divide(features, norms, out=self.matrices[key + "_unit"])
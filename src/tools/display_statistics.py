@@ -2,18 +2,20 @@ from __future__ import annotations
 import time
 from sklearn.neighbors import NearestNeighbors
 import os
+import sys
 from tqdm import tqdm
 import warnings
 from pandas import DataFrame
 from trimesh import Trimesh
 
-try:
-    from tools.descriptor_extraction import *
-except ModuleNotFoundError:
-    try:
-        from descriptor_extraction import *
-    except ModuleNotFoundError:
-        from src.tools.descriptor_extraction import *
+# Scripts in this directory are run directly, so the src directory is added to the path to always import the
+# descriptor module as tools.descriptor_extraction. Numba can only load its on-disk cache of the descriptor kernel
+# under the module name that it was compiled under
+src_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from tools.descriptor_extraction import *
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
 csv_file_path = os.path.join('src', 'tools', 'outputs', 'shape_data.csv')
@@ -28,6 +30,9 @@ def histogram(df: DataFrame, column_name: str, class_name: str | None, show: boo
     :param class_name: Name of the class in case we want class-specific histograms
     :param show: Controls whether the histogram will be shown or not
     """
+    # Imported here so that modules which only need return_neighbors do not have to load matplotlib
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 6))
     n, bins, patches = plt.hist(df[column_name], bins=35, edgecolor='k', alpha=0.7, label=column_name)
     plt.axvline(df[column_name].mean(), color='r', linestyle='dashed', linewidth=2,
@@ -166,11 +171,12 @@ def return_bounding_box(model_name: str, mesh: Trimesh) -> list[list[float]]:
 
         shape = df[df['Shape Name'] == model_name]
         bounding_box = shape.iloc[0]['3D Bounding Box']
-        # Remove unwanted characters like [ and ], then split by newline
-        lines = bounding_box.replace('[', '').replace(']', '').strip().split('\r\n')
+        # Remove unwanted characters like [ and ], which older files still contain, and split by commas or whitespace
+        values = bounding_box.replace('[', ' ').replace(']', ' ').replace(',', ' ').split()
 
-        # For each line, split by whitespace and convert to float
-        bounding_box = [list(map(float, line.split())) for line in lines]
+        # The first 3 values are the minimum corner and the last 3 the maximum corner
+        coordinates = list(map(float, values))
+        bounding_box = [coordinates[:3], coordinates[3:]]
     else:
         bounding_box = mesh.bounds
 
@@ -1,8 +1,99 @@
 from __future__ import annotations
 import os
+import pickle
 from tqdm import tqdm
 import csv
-import trimesh
+import re
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from typing import Iterator
+from contextlib import nullcontext
+
+
+CSV_BUFFER_SIZE = 1 << 20
+
+# Version of the cached rows, should be increased whenever the rows that load_shape_statistics returns change
+STATISTICS_CACHE_VERSION = 1
+
+# Vertex and face lines of .obj files
+VERTEX_PATTERN = re.compile(rb'(?m)^v[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)')
+FACE_PATTERN = re.compile(rb'(?m)^f[ \t]+(.*)$')
+
+
+def format_bounding_box(bounding_box: np.ndarray) -> str:
+    """
+    Formats a 3D bounding box as a single line for the CSV.
+    :param bounding_box: Bounding box as the minimum and maximum corner.
+    :return: Comma-separated minimum x, y, z and maximum x, y, z coordinates.
+    """
+    return ','.join(map(str, np.ravel(bounding_box).tolist()))
+
+
+def load_shape_statistics(path: tuple[str, str, str]) -> tuple[str, str, int, int, str, str]:
+    """
+    Scans a .obj file for the statistics that are saved for it, without building the mesh.
+    :param path: Tuple containing the model's path, class and name.
+    :return: CSV row of the model, with the values in the order of the headers.
+    """
+    with open(path[0], 'rb') as file:
+        data = file.read()
+
+    # Extract the coordinates of all vertices at once, the axis-aligned 3D bounding box is then a NumPy reduction
+    vertices = np.array(VERTEX_PATTERN.findall(data)).astype(np.float64).reshape(-1, 3)
+    if len(vertices) > 0:
+        bounding_box = np.stack([vertices.min(axis=0), vertices.max(axis=0)])
+    else:
+        bounding_box = np.full((2, 3), np.nan)
+
+    # Polygons with more than 3 vertices are counted as the triangles they are split into
+    faces = FACE_PATTERN.findall(data)
+    number_of_faces = len(b' '.join(faces).split()) - 2 * len(faces)
+
+    # The row is already formatted here, so that the main process only has to write it
+    return path[2], path[1], len(vertices), number_of_faces, 'Triangle', format_bounding_box(bounding_box)
+
+
+def iterate_model_files(directory: str) -> Iterator[os.DirEntry]:
+    """
+    Recursively finds all .obj files in a directory.
+    :param directory: Directory to search.
+    :return: Iterator over the directory entries of the .obj files.
+    """
+    # Unlike os.walk, scandir entries carry their file type, so directories can be told apart without extra stat calls
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iterate_model_files(entry.path)
+            elif entry.name.lower().endswith('.obj'):
+                yield entry
+
+
+def load_statistics_cache(cache_path: str) -> dict[str, tuple[tuple[int, int], tuple]]:
+    """
+    Loads the rows of the previously scanned models.
+    :param cache_path: Path to the cache file.
+    :return: Dictionary from model path to the (modification time, size) of the file and its row, empty if there
+    is no usable cache.
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cache = pickle.load(cache_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get('version') != STATISTICS_CACHE_VERSION:
+        return {}
+    return cache['rows']
+
+
+def save_statistics_cache(cache_path: str, rows: dict[str, tuple[tuple[int, int], tuple]]) -> None:
+    """
+    Saves the rows of the scanned models, so that unchanged models do not have to be scanned again.
+    :param cache_path: Path to the cache file.
+    :param rows: Dictionary from model path to the (modification time, size) of the file and its row.
+    """
+    with open(cache_path, 'wb') as cache_file:
+        pickle.dump({'version': STATISTICS_CACHE_VERSION, 'rows': rows}, cache_file)
 
 
 def save_data(meshes: dict | None) -> None:
@@ -13,82 +104,63 @@ def save_data(meshes: dict | None) -> None:
     base = os.path.dirname(__file__)
     models_path = os.path.join(base, '../../resources/models')
 
-    shape_data = []
-
-    if meshes:
-        for key, mesh in meshes.items():
-            bounding_box = mesh[2].bounds
-            current_model_vertices = len(mesh[2].vertices)
-            current_model_faces = len(mesh[2].faces)
-
-            # Save shape data
-            if len(shape_data) == 0:
-                shape_data = [
-                    {'Shape Name': mesh[0],
-                     'Shape Class': mesh[1],
-                     'Number of Vertices': current_model_vertices,
-                     'Number of Faces': current_model_faces,
-                     'Type of Faces': 'Triangle',
-                     '3D Bounding Box': bounding_box}
-                ]
-            else:
-                shape_data.append({'Shape Name': mesh[0],
-                                   'Shape Class': mesh[1],
-                                   'Number of Vertices': current_model_vertices,
-                                   'Number of Faces': current_model_faces,
-                                   'Type of Faces': 'Triangle',
-                                   '3D Bounding Box': bounding_box})
-    else:
-        # Iterate through all .obj files
-        for root, dirs, files in tqdm(os.walk(models_path), desc="Parsing .obj files"):
-            if len(files) > 0:
-                len_files = len(files)
-
-                for i in range(len_files):
-                    file = files[i]
-                    current_class = os.path.basename(os.path.normpath(root))
-                    file_path = os.path.join(root, file)
-
-                    # Get axis-aligned 3D bounding box
-                    mesh = trimesh.load_mesh(file_path)
-                    bounding_box = mesh.bounds
-                    number_of_vertices = len(mesh.vertices)
-                    number_of_faces = len(mesh.faces)
-
-                    if len(shape_data) == 0:
-                        shape_data = [
-                            {'Shape Name': file,
-                             'Shape Class': current_class,
-                             'Number of Vertices': number_of_vertices,
-                             'Number of Faces': number_of_faces,
-                             'Type of Faces': 'Triangle',
-                             '3D Bounding Box': bounding_box}
-                        ]
-                    else:
-                        shape_data.append({'Shape Name': file,
-                                           'Shape Class': current_class,
-                                           'Number of Vertices': number_of_vertices,
-                                           'Number of Faces': number_of_faces,
-                                           'Type of Faces': 'Triangle',
-                                           '3D Bounding Box': bounding_box})
-
-    # Path to the CSV file
-    csv_file_path = os.path.join('outputs', 'shape_data.csv')
+    # Path to the CSV file, the outputs directory is created if it does not exist yet
+    csv_path = os.path.join(base, 'outputs', 'shape_data.csv')
+    cache_path = os.path.join(base, 'outputs', 'shape_data_cache.pkl')
+    os.makedirs(os.path.dirname(csv_path), exist_ok=True)
 
     # CSV file headers
     headers = ['Shape Name', 'Shape Class', 'Number of Vertices', 'Number of Faces', 'Type of Faces', '3D Bounding Box']
 
-    csv_path = os.path.join(base, csv_file_path)
-    # Create CSV file and add headers
-    with open(csv_path, mode='w', newline='') as file:
-        writer = csv.writer(file, delimiter=';')
+    # Create CSV file and write every shape as soon as its data is known, the large buffer keeps the number of
+    # write calls small
+    with open(csv_path, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as csv_file:
+        writer = csv.writer(csv_file, delimiter=';')
         writer.writerow(headers)
 
-    # Append shape data to the CSV file
-    with open(csv_path, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers, delimiter=';')
-        for shape in shape_data:
-            writer.writerow(shape)
+        if meshes:
+            for key, mesh in meshes.items():
+                bounding_box = format_bounding_box(mesh[2].bounds)
+                current_model_vertices = len(mesh[2].vertices)
+                current_model_faces = len(mesh[2].faces)
+
+                # Save shape data, the values are in the order of the headers
+                writer.writerow(
+                    (mesh[0], mesh[1], current_model_vertices, current_model_faces, 'Triangle', bounding_box))
+        else:
+            # Collect all .obj files, only the models that changed since the last run have to be scanned again.
+            # The cache is keyed by the absolute path so that it does not depend on the working directory
+            cached_rows = load_statistics_cache(cache_path)
+            updated_rows = {}
+            paths_to_scan = []
+            for entry in iterate_model_files(os.path.abspath(models_path)):
+                file_stat = entry.stat()
+                file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+                cached_row = cached_rows.get(entry.path)
+                if cached_row is not None and cached_row[0] == file_key:
+                    updated_rows[entry.path] = cached_row
+                else:
+                    # The class is the name of the directory that contains the model
+                    current_class = os.path.basename(os.path.dirname(entry.path))
+                    updated_rows[entry.path] = (file_key, None)
+                    paths_to_scan.append((entry.path, current_class, entry.name))
+
+            # Use multiprocessing to parallelize the loading and the formatting of the rows, imap keeps the scanned
+            # rows in the order of the files so they can be merged with the cached ones as they arrive. No processes
+            # are started when every row comes from the cache
+            num_processes = min(cpu_count(), len(paths_to_scan))
+            with Pool(processes=num_processes) if num_processes > 0 else nullcontext() as pool:
+                scanned_rows = pool.imap(load_shape_statistics, paths_to_scan, chunksize=8) if pool else iter(())
+                # One progress update per model file, the cached ones complete immediately
+                num_cached = len(updated_rows) - len(paths_to_scan)
+                for absolute_path, (file_key, row) in tqdm(updated_rows.items(), total=len(updated_rows), unit='file',
+                                                           desc=f"Parsing .obj files ({num_cached} cached)"):
+                    if row is None:
+                        row = next(scanned_rows)
+                        updated_rows[absolute_path] = (file_key, row)
+                    writer.writerow(row)
+
+            save_statistics_cache(cache_path, updated_rows)
 
 
 if __name__ == '__main__':